@@ -1,8 +1,27 @@
 import os
+import sys
+import time
 import json
+import asyncio
+import hashlib
+import io
+import gzip
+import itertools
 import logging
-import uuid
+from collections import OrderedDict, deque
+from operator import itemgetter
 from pathlib import Path
+from typing import Awaitable, Iterable, NamedTuple
+import ijson
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import faiss
+    import numpy as np
+except ImportError:
+    faiss = None
 from telegram import Update
 from telegram.ext import (
     Application,
@@ -10,21 +29,48 @@ from telegram.ext import (
     MessageHandler,
     filters,
     ContextTypes,
-    ConversationHandler
+    ConversationHandler,
+    PicklePersistence,
+    PersistenceInput,
+    BaseUpdateProcessor
 )
-import openai
+from openai import AsyncOpenAI
+from aiolimiter import AsyncLimiter
 from config import TELEGRAM_BOT_TOKEN, OPENAI_API_KEY
 
 
 # ===== КОНСТАНТЫ =====
 CHATS_DIR = Path("Chats")
+CHATS_SHARDS = 256
+ARCHIVE_SUFFIX = ".json.gz"
+STATE_FILE = Path("bot_state.pickle")
+STATE_UPDATE_INTERVAL = 60
 DEFAULT_MESSAGES_COUNT = 750
+RESPONSE_CACHE_SIZE = 10_000
+PROMPT_CACHE_SIZE = 256
+HISTORY_MAX_MESSAGES = 20
+
+# Параметры генерации
+# Модель с автоматическим кэшированием префикса промпта на стороне OpenAI
+OPENAI_MODEL = "gpt-4o-mini"
+OPENAI_TEMPERATURE = 0.7
+OPENAI_MAX_TOKENS = 500
+OPENAI_RPM_LIMIT = 500
+OPENAI_MAX_IN_FLIGHT = 50
+MAX_CONCURRENT_UPDATES = 256
+AI_ERROR_MESSAGE = "⚠️ Ошибка генерации ответа. Попробуйте позже."
+
+# Семантический кэш
+EMBEDDING_MODEL = "text-embedding-3-small"
+SEMANTIC_CACHE_THRESHOLD = 0.9
+SEMANTIC_CACHES_LOADED = 256
 
 # Состояния диалога
 UPLOAD, GET_NAME, CHAT_MODE = range(3)
 
-# Инициализация OpenAI
-openai.api_key = OPENAI_API_KEY
+# Фильтры сообщений
+TEXT_NOT_CMD = filters.TEXT & ~filters.COMMAND
+JSON_DOC_FILTER = filters.Document.FileExtension("json")
 
 # Настройка логгирования
 logging.basicConfig(
@@ -33,93 +79,421 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Префикс имен архивов (PID процесса, вычисляется один раз) и счетчик сохраненных архивов
+_ARCHIVE_PREFIX = f"{os.getpid():x}"
+_archive_counter = itertools.count()
+
+# LRU-кэш ответов: ключ -> текст ответа
+_response_cache = OrderedDict()
+
+# LRU-кэш промптов: путь к архиву переписки -> промпт.
+# Промпты не хранятся в user_data, чтобы не раздувать файл состояния
+_prompts = OrderedDict()
+
+# Извлечение текста из сущности форматированного сообщения
+_entity_text = itemgetter("text")
+
+# Загруженные экспорты, ожидающие имени собеседника: user_id -> байты JSON.
+# Хранятся вне user_data, чтобы не попадать в файл состояния
+_pending_exports = {}
+
+# Загруженные семантические кэши (LRU): "<user_id>_<sha256 промпта>" -> SemanticCache
+_semantic_caches = OrderedDict()
+
+class Msg(NamedTuple):
+    """Очищенное сообщение собеседника"""
+    from_: str
+    text: str
+    date: str
+
 # ===== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ =====
 def ensure_dirs():
     """Создает необходимые директории"""
     CHATS_DIR.mkdir(exist_ok=True)
 
-def clean_data(data: list, interlocutor_name: str, max_messages: int = DEFAULT_MESSAGES_COUNT) -> list:
+def is_telegram_export(export: bytes) -> bool:
+    """Потоково проверяет, что в JSON есть список messages"""
+    for prefix, event, _ in ijson.parse(io.BytesIO(export)):
+        if prefix == "messages" and event == "start_array":
+            return True
+    return False
+
+def iter_messages(f) -> Iterable:
+    """Потоково отдает сообщения из экспорта Telegram по одному"""
+    return ijson.items(f, "messages.item")
+
+def clean_data(data: Iterable, interlocutor_name: str, max_messages: int = DEFAULT_MESSAGES_COUNT) -> list:
     """
     Очищает данные переписки:
     1. Оставляет только сообщения указанного собеседника
     2. Извлекает текстовый контент из сообщений
     3. Берет последние max_messages сообщений
+    
+    Возвращает список записей Msg.
     """
-    cleaned_messages = []
+    interlocutor_name = sys.intern(interlocutor_name)
+    cleaned_messages = deque(maxlen=max_messages)
+    append = cleaned_messages.append
     
-    for msg in reversed(data):
-        if len(cleaned_messages) >= max_messages:
-            break
-            
-        if not isinstance(msg, dict):
-            continue
-            
-        # Проверяем отправителя
-        if msg.get("from") != interlocutor_name:
+    for msg in data:
+        # Проверяем тип и отправителя
+        if not isinstance(msg, dict) or msg.get("from") != interlocutor_name:
             continue
             
         # Извлекаем текст сообщения
-        text = ""
-        if "text" in msg:
-            if isinstance(msg["text"], str):
-                text = msg["text"]
-            elif isinstance(msg["text"], list):
-                text = "".join(
-                    entity["text"] 
-                    for entity in msg["text"] 
-                    if isinstance(entity, dict) and "text" in entity
-                )
+        text = msg.get("text", "")
+        if not isinstance(text, str):
+            try:
+                # Быстрый путь: список сущностей, у каждой есть текст
+                text = "".join(map(_entity_text, text))
+            except (TypeError, KeyError):
+                # Смешанный список: берем только сущности с текстом
+                try:
+                    text = "".join(
+                        entity["text"] 
+                        for entity in text 
+                        if isinstance(entity, dict) and "text" in entity
+                    )
+                except TypeError:
+                    continue
         
         if not text.strip():
             continue
             
-        cleaned_messages.append({
-            "from": msg["from"],
-            "text": text,
-            "date": msg.get("date", "")
-        })
+        append(Msg(interlocutor_name, text, msg.get("date", "")))
     
-    return list(reversed(cleaned_messages))
+    return list(cleaned_messages)
+
+def load_cleaned_data(export: bytes, interlocutor_name: str) -> list:
+    """Потоково разбирает экспорт и возвращает очищенные сообщения собеседника"""
+    return clean_data(iter_messages(io.BytesIO(export)), interlocutor_name)
+
+def chats_subdir(user_id: int) -> Path:
+    """Возвращает подкаталог пользователя: архивы раскладываются по ним, чтобы Chats/ не разрастался"""
+    return CHATS_DIR / f"{user_id % CHATS_SHARDS:02x}"
 
 def save_conversation(user_id: int, data: list):
-    """Сохраняет переписку в JSON файл"""
-    filename = CHATS_DIR / f"{user_id}_{uuid.uuid4().hex}.json"
-    with open(filename, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    """Сохраняет переписку в компактный JSON файл, сжатый gzip"""
+    data = [{"from": msg.from_, "text": msg.text, "date": msg.date} for msg in data]
+    subdir = chats_subdir(user_id)
+    subdir.mkdir(exist_ok=True)
+    # time_ns — настенные часы и может идти назад, счетчик гарантирует уникальность в процессе
+    filename = subdir / f"{user_id}_{_ARCHIVE_PREFIX}_{time.time_ns():x}_{next(_archive_counter):x}{ARCHIVE_SUFFIX}"
+    if orjson is not None:
+        with gzip.open(filename, 'wb', compresslevel=1) as f:
+            f.write(orjson.dumps(data))
+    else:
+        with gzip.open(filename, 'wt', encoding='utf-8', compresslevel=1) as f:
+            json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
     return filename
 
+def load_conversation(archive_path: Path) -> list:
+    """Читает сохраненную переписку из архива"""
+    with gzip.open(archive_path, 'rb') as f:
+        raw = f.read()
+    data = orjson.loads(raw) if orjson is not None else json.loads(raw)
+    return [Msg(msg["from"], msg["text"], msg["date"]) for msg in data]
+
 def generate_prompt(interlocutor_name: str, cleaned_data: list) -> str:
     """Генерирует промпт для обучения на основе очищенных данных"""
-    messages = "\n".join(
-        f"{msg['from']} ({msg['date']}): {msg['text']}" 
-        for msg in cleaned_data
-    )
-    return (
+    parts = [
         f"Ты имитируешь стиль общения человека по имени {interlocutor_name}.\n"
         "Вот примеры его сообщений:\n\n"
-        f"{messages}\n\n"
+    ]
+    append = parts.append
+    for msg in cleaned_data:
+        append(msg.from_)
+        append(' (')
+        append(msg.date)
+        append('): ')
+        append(msg.text)
+        append('\n')
+    append(
+        "\n"
         "Отвечай так, как бы ответил этот человек, сохраняя его стиль, "
         "манеру речи и особенности общения. Не упоминай, что ты ИИ. "
         "Длина ответа должна быть естественной для диалога."
         "Отвечай ТОЛЬКО текстом сообщения, без указания имени, даты или других метаданных."
     )
+    return "".join(parts)
+
+def remember_prompt(archive_path: Path, prompt: str):
+    """Кладет промпт в LRU-кэш, вытесняя самый старый при переполнении"""
+    key = str(archive_path)
+    _prompts[key] = prompt
+    _prompts.move_to_end(key)
+    if len(_prompts) > PROMPT_CACHE_SIZE:
+        _prompts.popitem(last=False)
 
-async def get_ai_response(prompt: str, user_input: str) -> str:
-    """Получает ответ от OpenAI с имитацией стиля"""
+async def get_prompt(user_data: dict) -> str:
+    """Возвращает промпт пользователя, при необходимости пересобирая его из архива"""
+    archive_path = user_data['archive_path']
+    prompt = _prompts.get(str(archive_path))
+    if prompt is not None:
+        _prompts.move_to_end(str(archive_path))
+        return prompt
+    # Архив хранит те же записи, поэтому промпт получается побайтно тем же
+    cleaned_data = await asyncio.to_thread(load_conversation, archive_path)
+    prompt = generate_prompt(user_data['interlocutor_name'], cleaned_data)
+    remember_prompt(archive_path, prompt)
+    return prompt
+
+def response_cache_key(prompt: str, history: Iterable, user_input: str) -> bytes:
+    """Строит ключ кэша из промпта, истории, запроса и параметров, влияющих на ответ"""
+    key = hashlib.sha256(
+        f"{OPENAI_MODEL}\0{OPENAI_TEMPERATURE}\0{OPENAI_MAX_TOKENS}\0{prompt}\0".encode()
+    )
+    for message in history:
+        key.update(f"{message['role']}\0{message['content']}\0".encode())
+    key.update(user_input.encode())
+    return key.digest()
+
+def get_cached_response(key: bytes):
+    """Возвращает ответ из кэша или None"""
+    response = _response_cache.get(key)
+    if response is not None:
+        _response_cache.move_to_end(key)
+    return response
+
+def cache_response(key: bytes, response: str):
+    """Сохраняет ответ в кэш, вытесняя самый старый при переполнении"""
+    _response_cache[key] = response
+    _response_cache.move_to_end(key)
+    if len(_response_cache) > RESPONSE_CACHE_SIZE:
+        _response_cache.popitem(last=False)
+
+def write_file_atomic(path: Path, data: bytes):
+    """Записывает файл через временный файл, чтобы не оставить его недописанным"""
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+class SemanticCache:
+    """Кэш ответов по смысловой близости запросов (FAISS, косинусная мера)"""
+
+    def __init__(self, base_path: Path):
+        self.index_path = base_path.with_name(base_path.name + ".faiss")
+        self.responses_path = base_path.with_name(base_path.name + ".responses.json")
+        self.index = None
+        self.responses = []
+        if self.index_path.exists() and self.responses_path.exists():
+            try:
+                self.load()
+            except Exception as e:
+                logger.error(f"Semantic cache load error ({self.index_path}): {e}")
+                self.index = None
+                self.responses = []
+
+    def load(self):
+        """Читает индекс и ответы с диска, проверяя их согласованность"""
+        index = faiss.read_index(str(self.index_path))
+        raw = self.responses_path.read_bytes()
+        responses = orjson.loads(raw) if orjson is not None else json.loads(raw)
+        if index.ntotal != len(responses):
+            raise ValueError(f"index has {index.ntotal} vectors, but {len(responses)} responses")
+        self.index = index
+        self.responses = responses
+
+    def __len__(self):
+        return 0 if self.index is None else self.index.ntotal
+
+    def lookup(self, vec):
+        """Возвращает ответ на самый похожий запрос или None"""
+        if self.index is None or self.index.ntotal == 0:
+            return None
+        try:
+            scores, ids = self.index.search(vec, 1)
+            if scores[0, 0] > SEMANTIC_CACHE_THRESHOLD:
+                return self.responses[ids[0, 0]]
+        except Exception as e:
+            logger.error(f"Semantic cache lookup error: {e}")
+        return None
+
+    def add(self, vec, response: str):
+        """Добавляет запрос с ответом и сохраняет индекс рядом с архивом"""
+        if self.index is None:
+            self.index = faiss.IndexFlatIP(vec.shape[1])
+        self.index.add(vec)
+        self.responses.append(response)
+        try:
+            if orjson is not None:
+                responses = orjson.dumps(self.responses)
+            else:
+                responses = json.dumps(self.responses, ensure_ascii=False).encode()
+            write_file_atomic(self.responses_path, responses)
+            write_file_atomic(self.index_path, faiss.serialize_index(self.index).tobytes())
+        except Exception as e:
+            logger.error(f"Semantic cache save error ({self.index_path}): {e}")
+
+async def get_semantic_cache(user_id: int, prompt: str):
+    """
+    Возвращает семантический кэш пары (пользователь, промпт) или None.
+    Кэш общий для всех загрузок одной и той же переписки с тем же собеседником.
+    """
+    if faiss is None:
+        return None
+    key = f"{user_id}_{hashlib.sha256(prompt.encode()).hexdigest()}"
+    cache = _semantic_caches.get(key)
+    if cache is None:
+        # Индекс читается с диска в отдельном потоке, словарь меняется только в цикле событий
+        # Подкаталог пользователя уже создан при сохранении архива
+        cache = await asyncio.to_thread(SemanticCache, chats_subdir(user_id) / key)
+        _semantic_caches[key] = cache
+        if len(_semantic_caches) > SEMANTIC_CACHES_LOADED:
+            _semantic_caches.popitem(last=False)
+    else:
+        _semantic_caches.move_to_end(key)
+    return cache
+
+async def embed_text(client: AsyncOpenAI, text: str):
+    """Возвращает нормированный эмбеддинг текста или None при ошибке"""
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
+        response = await client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+    except Exception as e:
+        logger.error(f"OpenAI embedding error: {e}")
+        return None
+    vec = np.array([response.data[0].embedding], dtype=np.float32)
+    faiss.normalize_L2(vec)
+    return vec
+
+async def get_ai_response(client: AsyncOpenAI, prompt: str, user_input: str, history: Iterable = ()) -> str:
+    """Получает ответ от OpenAI с имитацией стиля с учетом недавней истории диалога"""
+    try:
+        response = await client.chat.completions.create(
+            model=OPENAI_MODEL,
+            # Системный промпт всегда первый и не меняется между репликами,
+            # поэтому OpenAI переиспользует его закэшированный префикс
             messages=[
                 {"role": "system", "content": prompt},
+                *history,
                 {"role": "user", "content": user_input}
             ],
-            temperature=0.7,
-            max_tokens=500
+            temperature=OPENAI_TEMPERATURE,
+            max_tokens=OPENAI_MAX_TOKENS
         )
-        return response.choices[0].message['content'].strip()
+        return response.choices[0].message.content.strip()
     except Exception as e:
         logger.error(f"OpenAI error: {e}")
-        return "⚠️ Ошибка генерации ответа. Попробуйте позже."
+        return AI_ERROR_MESSAGE
+
+async def process_ai_request(client: AsyncOpenAI, limiter: AsyncLimiter, in_flight: asyncio.Semaphore,
+                             queue: asyncio.Queue, request: tuple):
+    """Выполняет один запрос из очереди и передает ответ ожидающему обработчику"""
+    prompt, user_input, history, future = request
+    response = AI_ERROR_MESSAGE
+    try:
+        await limiter.acquire()
+        response = await get_ai_response(client, prompt, user_input, history)
+    except Exception as e:
+        logger.error(f"OpenAI request error: {e}")
+    finally:
+        # Ожидающий обработчик получает ответ даже при отмене или сбое
+        if not future.done():
+            future.set_result(response)
+        in_flight.release()
+        queue.task_done()
+
+async def openai_worker(app: Application):
+    """Разбирает общую очередь запросов к OpenAI с учетом лимитов"""
+    client = app.bot_data['openai']
+    queue = app.bot_data['openai_queue']
+    tasks = app.bot_data['openai_tasks']
+    limiter = app.bot_data['openai_limiter']
+    in_flight = app.bot_data['openai_in_flight']
+    
+    while True:
+        # Слот занимается до извлечения запроса, чтобы воркер не держал его у себя
+        await in_flight.acquire()
+        try:
+            request = await queue.get()
+        except BaseException:
+            in_flight.release()
+            raise
+        task = asyncio.create_task(process_ai_request(client, limiter, in_flight, queue, request))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+def start_openai_worker(app: Application):
+    """Запускает обработчик очереди и перезапускает его при падении"""
+    def on_done(task: asyncio.Task):
+        if task.cancelled():
+            return
+        logger.error("OpenAI worker crashed, restarting", exc_info=task.exception())
+        start_openai_worker(app)
+    
+    worker = asyncio.create_task(openai_worker(app))
+    worker.add_done_callback(on_done)
+    app.bot_data['openai_worker'] = worker
+
+async def request_ai_response(bot_data: dict, prompt: str, user_input: str, history: Iterable = ()) -> str:
+    """Ставит запрос в очередь к OpenAI и дожидается ответа"""
+    future = asyncio.get_running_loop().create_future()
+    await bot_data['openai_queue'].put((prompt, user_input, list(history), future))
+    return await future
+
+async def start_openai(app: Application):
+    """Создает клиент OpenAI и запускает обработчик очереди запросов"""
+    # Один асинхронный клиент на все приложение: общий пул соединений
+    app.bot_data['openai'] = AsyncOpenAI(api_key=OPENAI_API_KEY)
+    app.bot_data['openai_queue'] = asyncio.Queue()
+    app.bot_data['openai_tasks'] = set()
+    app.bot_data['openai_limiter'] = AsyncLimiter(OPENAI_RPM_LIMIT, 60)
+    app.bot_data['openai_in_flight'] = asyncio.Semaphore(OPENAI_MAX_IN_FLIGHT)
+    start_openai_worker(app)
+
+async def close_openai(app: Application):
+    """Останавливает обработку очереди и закрывает соединения клиента OpenAI"""
+    app.bot_data['openai_worker'].cancel()
+    
+    # Отменяем выполняющиеся запросы: их ожидающие получат сообщение об ошибке
+    tasks = list(app.bot_data['openai_tasks'])
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    
+    # Запросы, оставшиеся в очереди, тоже завершаем ошибкой
+    queue = app.bot_data['openai_queue']
+    while not queue.empty():
+        *_, future = queue.get_nowait()
+        if not future.done():
+            future.set_result(AI_ERROR_MESSAGE)
+    
+    await app.bot_data['openai'].close()
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обрабатывает апдейты разных пользователей параллельно,
+    а апдейты одного пользователя — строго по очереди.
+    Так ConversationHandler и user_data не видят гонок внутри диалога,
+    а ожидание ответа OpenAI одним пользователем не задерживает остальных.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # user_id -> [блокировка, число апдейтов в работе или ожидании]
+        self._user_locks = {}
+
+    async def do_process_update(self, update: object, coroutine: Awaitable):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await coroutine
+            return
+        
+        entry = self._user_locks.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._user_locks[user.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
 
 # ===== ОБРАБОТЧИКИ КОМАНД =====
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -142,40 +516,29 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_json(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка полученного JSON-файла"""
-    user = update.message.from_user
-    user_id = user.id
-    
     try:
-        # Скачивание файла
+        # Скачивание файла в память
         file = await context.bot.get_file(update.message.document.file_id)
-        json_path = CHATS_DIR / f"temp_{user_id}.json"
-        await file.download_to_drive(json_path)
-        
-        # Загрузка данных
-        with open(json_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        export = bytes(await file.download_as_bytearray())
         
         # Проверяем структуру JSON
-        if "messages" not in data or not isinstance(data["messages"], list):
+        if not await asyncio.to_thread(is_telegram_export, export):
             await update.message.reply_text("❌ Некорректный формат JSON: отсутствует список messages")
             return ConversationHandler.END
         
-        # Сохраняем данные для обработки
-        context.user_data['json_data'] = data
+        # Сохраняем сырой экспорт: сообщения разбираются потоково после ввода имени
+        _pending_exports[update.message.from_user.id] = export
         await update.message.reply_text(
             "✅ Файл получен! Теперь введи имя человека, "
             "стиль которого нужно имитировать (как оно указано в переписке):"
         )
         return GET_NAME
         
-    except json.JSONDecodeError:
+    except ijson.JSONError:
         await update.message.reply_text("❌ Ошибка чтения JSON. Проверьте целостность файла.")
     except Exception as e:
         logger.error(f"JSON processing error: {e}")
         await update.message.reply_text("❌ Ошибка обработки файла. Проверьте формат.")
-    finally:
-        if 'json_path' in locals() and json_path.exists():
-            os.remove(json_path)
     
     return ConversationHandler.END
 
@@ -183,16 +546,16 @@ async def handle_interlocutor_name(update: Update, context: ContextTypes.DEFAULT
     """Обработка имени собеседника"""
     interlocutor_name = update.message.text
     user_data = context.user_data
+    user_id = update.message.from_user.id
     
-    if 'json_data' not in user_data:
+    if user_id not in _pending_exports:
         await update.message.reply_text("❌ Данные не найдены. Начните заново с /start")
         return ConversationHandler.END
     
     try:
         # Обработка данных
-        cleaned_data = clean_data(
-            user_data['json_data']["messages"], 
-            interlocutor_name
+        cleaned_data = await asyncio.to_thread(
+            load_cleaned_data, _pending_exports[user_id], interlocutor_name
         )
         
         if not cleaned_data:
@@ -202,13 +565,22 @@ async def handle_interlocutor_name(update: Update, context: ContextTypes.DEFAULT
             )
             return GET_NAME
         
+        # Сырой экспорт больше не нужен
+        del _pending_exports[user_id]
+        
         # Сохранение и подготовка промпта
-        save_path = save_conversation(update.message.from_user.id, cleaned_data)
+        save_path = await asyncio.to_thread(
+            save_conversation, user_id, cleaned_data
+        )
         prompt = generate_prompt(interlocutor_name, cleaned_data)
         
-        # Сохраняем промпт в контексте пользователя
-        user_data['prompt'] = prompt
-        user_data['history'] = []
+        # Промпт строится один раз и дальше не изменяется, чтобы префикс
+        # запроса оставался стабильным; в user_data — только данные для его
+        # восстановления из архива после перезапуска
+        remember_prompt(save_path, prompt)
+        user_data['interlocutor_name'] = interlocutor_name
+        user_data['archive_path'] = save_path
+        user_data['history'] = deque(maxlen=HISTORY_MAX_MESSAGES)
         
         await update.message.reply_text(
             f"✅ Анализ переписки завершен!\n"
@@ -219,8 +591,14 @@ async def handle_interlocutor_name(update: Update, context: ContextTypes.DEFAULT
         )
         return CHAT_MODE
         
+    except ijson.JSONError:
+        # Повреждение экспорта обнаруживается только при полном разборе
+        _pending_exports.pop(user_id, None)
+        await update.message.reply_text("❌ Ошибка чтения JSON. Проверьте целостность файла.")
+        return ConversationHandler.END
     except Exception as e:
         logger.error(f"Data processing error: {e}")
+        _pending_exports.pop(user_id, None)
         await update.message.reply_text("❌ Ошибка обработки данных. Попробуйте другой файл.")
         return ConversationHandler.END
 
@@ -228,23 +606,65 @@ async def chat_mode(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Режим общения с имитацией стиля"""
     user_input = update.message.text
     user_data = context.user_data
+    history = user_data['history']
     
-    # Добавляем сообщение в историю
-    user_data['history'].append({"role": "user", "content": user_input})
+    try:
+        prompt = await get_prompt(user_data)
+    except Exception as e:
+        logger.error(f"Prompt restore error: {e}")
+        await update.message.reply_text("❌ Данные не найдены. Начните заново с /start")
+        return ConversationHandler.END
     
-    # Генерируем ответ
-    response = await get_ai_response(
-        prompt=user_data['prompt'],
-        user_input=user_input
-    )
+    # Генерируем ответ, если такого или похожего запроса еще не было
+    client = context.bot_data['openai']
+    cache_key = response_cache_key(prompt, history, user_input)
+    response = get_cached_response(cache_key)
+    vec = None
+    semantic_cache = None
+    # Семантический кэш сравнивает только текст запроса, поэтому применяется
+    # лишь к первой реплике диалога, пока ответ не зависит от истории. Кэш общий
+    # для всех загрузок того же промпта, так что первая реплика нового диалога
+    # находит ответы, сохраненные в прошлых диалогах
+    if response is None and not history:
+        semantic_cache = await get_semantic_cache(update.message.from_user.id, prompt)
+        # В пустом индексе искать нечего: эмбеддинг нужен только для добавления
+        if semantic_cache is not None and len(semantic_cache):
+            vec = await embed_text(client, user_input)
+            if vec is not None:
+                response = semantic_cache.lookup(vec)
+    if response is None:
+        response = await request_ai_response(
+            context.bot_data,
+            prompt=prompt,
+            user_input=user_input,
+            history=history
+        )
+        if response != AI_ERROR_MESSAGE:
+            cache_response(cache_key, response)
+        else:
+            semantic_cache = None
+    else:
+        # Ответ взят из кэша, добавлять в семантический индекс нечего
+        semantic_cache = None
     
-    # Сохраняем ответ и отправляем
-    user_data['history'].append({"role": "assistant", "content": response})
+    # Сохраняем обмен в истории (ошибки туда не попадают) и отправляем ответ
+    if response != AI_ERROR_MESSAGE:
+        history.append({"role": "user", "content": user_input})
+        history.append({"role": "assistant", "content": response})
     await update.message.reply_text(response)
+    
+    # Новый ответ на первую реплику пополняет семантический кэш уже после отправки,
+    # чтобы эмбеддинг не задерживал ответ пользователю
+    if semantic_cache is not None:
+        if vec is None:
+            vec = await embed_text(client, user_input)
+        if vec is not None:
+            await asyncio.to_thread(semantic_cache.add, vec, response)
     return CHAT_MODE
 
 async def exit_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Выход из режима общения"""
+    _pending_exports.pop(update.message.from_user.id, None)
     await update.message.reply_text(
         "Выход из режима имитации.\n"
         "Чтобы начать заново, отправь новый JSON-файл или используй /start"
@@ -253,32 +673,55 @@ async def exit_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Отмена текущей операции"""
+    _pending_exports.pop(update.message.from_user.id, None)
     await update.message.reply_text("Операция отменена")
     return ConversationHandler.END
 
 # ===== ОСНОВНАЯ ФУНКЦИЯ =====
 def main():
     ensure_dirs()
+    if ijson.backend != "yajl2_c":
+        logger.warning(f"ijson использует медленный бэкенд '{ijson.backend}', установите yajl для C-парсера")
+    
+    # Сохраняем между перезапусками только состояние диалогов и user_data
+    # (имя собеседника, путь к архиву, короткая история); клиент OpenAI в bot_data
+    # не сохраняется. PicklePersistence синхронно перезаписывает весь файл на
+    # каждого изменившегося пользователя, поэтому user_data держим маленьким
+    persistence = PicklePersistence(
+        filepath=STATE_FILE,
+        store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+        update_interval=STATE_UPDATE_INTERVAL
+    )
     
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    app = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .persistence(persistence)
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .post_init(start_openai)
+        .post_shutdown(close_openai)
+        .build()
+    )
     
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler('start', start)],
         states={
             UPLOAD: [
-                MessageHandler(filters.Document.FileExtension("json"), handle_json),
+                MessageHandler(JSON_DOC_FILTER, handle_json),
                 CommandHandler('cancel', cancel)
             ],
             GET_NAME: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_interlocutor_name),
+                MessageHandler(TEXT_NOT_CMD, handle_interlocutor_name),
                 CommandHandler('cancel', cancel)
             ],
             CHAT_MODE: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, chat_mode),
+                MessageHandler(TEXT_NOT_CMD, chat_mode),
                 CommandHandler('exit', exit_chat)
             ]
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', cancel)],
+        name="imitation",
+        persistent=True
     )
     
     app.add_handler(conv_handler)